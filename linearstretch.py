@@ -48,6 +48,15 @@
 import bpy
 import bmesh
 import math
+import itertools
+import numpy as np
+from mathutils import Vector
+try :
+    from numba import njit, prange                          # optional; compiles the numeric kernels
+except ImportError :
+    njit = None                                             # not installed, use the NumPy paths
+    prange = range
+DEBUG = False                                               # True for diagnostic prints
 #
 #   Names of vertex groups in model.
 #   Model must use these.
@@ -63,129 +72,225 @@ PLATBOTTOM = "Bottom platform"                              # Single ref point,
 #   Railing info. Name of vertex group, normal to plane for selecting points, point on plane for selecting points
 RAILINGS = [("Railing L",Vector([1,0,0]),Vector([0,0,0])), 
            ("Railing R",Vector([-1,0,0]),Vector([0,0,0]))]            # long face of each railing, for UV equalization
+USEUVOPERATOR = False                                       # True to equalize with Blender's follow_active_quads operator
+NUMBAMINFACES = 100000                                      # use the Numba kernel only on meshes at least this big
+MINSTRETCH = 1e-6                                           # stretches shorter than this are treated as none
+COORDBUF = None                                             # scratch buffer for vertex coords, see getcoordbuf
            
            
 #
-#   findrailingfaces -- get points for railng of interest
+#   getcoordbuf -- scratch buffer for reading vertex coords
 #
-def findrailingfaces(obj, material, plane, planeloc) :
+def getcoordbuf(nverts) :
     '''
-    Select faces which are in front of plane and of desired material
+    Get an (nverts,3) float32 view of a buffer kept between calls.
+    
+    Repeated stretches would otherwise allocate a new coords array for
+    every object. The buffer grows geometrically when a bigger mesh
+    comes along. The contents are only good until the next call.
+    '''
+    global COORDBUF
+    if COORDBUF is None or len(COORDBUF) < nverts*3 :      # grow
+        size = max(nverts*3, 2*len(COORDBUF) if COORDBUF is not None else 0)
+        COORDBUF = np.empty(size, dtype=np.float32)
+    return COORDBUF[:nverts*3].reshape(nverts,3)
+           
+#
+#   getpolyindex -- index polygons by their vertices
+#
+def getpolyindex(obj) :
+    '''
+    Map sorted tuple of vertex indices to polygon index, for findpolyfromvertices
+    
+    Indices, not MeshPolygon objects, because those go stale on a mode change.
     '''
-    return [face for face in obj.data.faces if (face.co-planeloc).dot(plane) >= 0 and face.data.material == material] # vertices in front of plane  
+    return dict((tuple(sorted(polygon.vertices)), polygon.index) for polygon in obj.data.polygons)
 
 #
 #   findpolyfromvertices
 #
-def findpolyfromvertices(obj,verts) :
+def findpolyfromvertices(obj, vertixs, polyindex=None) :
     '''
     Takes list of vertex indicies, returns single matching face or None
+    
+    polyindex maps sorted tuple of polygon vertex indices to polygon index.
+    Build it once per mesh when looking up several faces.
     '''
-    vertsset = set([v.index for v in verts])        # indices of polygon, for comparison
-    print("Vertex set for face: %s" % (vertsset,))  # ***TEMP***
-    for item in obj.data.polygons.items() :         # for all polygons
-        (i, polygon) = item
-        polyset = set(polygon.vertices)
-        ####print("Vertex set for poly: %s" % (polyset,))  # ***TEMP***
-        if vertsset == set(polygon.vertices) :      # if all match
-            ####print("Face info: %s" % (dir(polygon))) # ***TEMP***
-            return polygon                          # found
-    return None                                     # no find
+    if polyindex is None :
+        polyindex = getpolyindex(obj)
+    vertskey = tuple(sorted(vertixs))               # indices of polygon, for comparison
+    ix = polyindex.get(vertskey)                    # matching polygon index or None
+    if ix is None :
+        return None
+    return obj.data.polygons[ix]                    # fetch fresh, valid in current mode
 
 #
-#   positivesideofplane  
+#   facesonpositiveside -- numeric kernel for findrailingfaces
 #
-def positivesideofplane(obj, poly, plane, planeloc) :
+def facesonpositiveside(loopstart, looptotal, loopvert, vertpositive, materials, materialix, out) :
     '''
-    True if poly is entirely on the positive side of the plane
+    Set out[p] for faces of material materialix with all verts on + side of plane.
+    
+    vertpositive is the per-vertex plane test. Only loops over NumPy
+    arrays, no Blender calls, so Numba can compile it. Faces are
+    independent, so they are spread across cores.
     '''
-    for vertix in poly.vertices :
-        keep = (obj.data.vertices[vertix].co-planeloc).dot(plane) > 0
-        ####print("Vertex %d: (%s)  %s" % (vertix, keep, obj.data.vertices[vertix].co)) # ***TEMP***
-        if (not keep) :
-            return(False)
-        ####print("Vertex %d: (%s)  %s" % (vertix, keep, obj.data.vertices[vertix].co)) # ***TEMP***
- 
-    ####print("Vertex %d: %s" % (vertix, obj.data.vertices[vertix].co)) # ***TEMP***
-    return(True)                                    # entirely on good side of the plane
-            
+    for p in prange(loopstart.shape[0]) :
+        ok = materials[p] == materialix
+        if ok :
+            for k in range(loopstart[p], loopstart[p] + looptotal[p]) :
+                if not vertpositive[loopvert[k]] :
+                    ok = False
+                    break
+        out[p] = ok
+
+if njit is not None :
+    try :
+        facesonpositiveside = njit(parallel=True, cache=True)(facesonpositiveside)
+    except RuntimeError :                                   # no cache location, e.g. run from a Text block
+        njit = None                                         # use the NumPy path
+
+#
+#   getmesharrays -- bulk read of vertex coords and loop topology
+#
+def getmesharrays(mesh) :
+    '''
+    Read vertex coords and polygon/loop topology with foreach_get.
+    
+    Returns (coords, loopstart, looptotal, loopvert, loopedge): coords is
+    (N,3) float32, the rest int32. Polygons are runs of loops, loopstart
+    and looptotal per polygon, loopvert and loopedge per loop.
+    Equalizing UVs changes none of these, so read them once per object.
+    coords is the getcoordbuf scratch buffer.
+    '''
+    nverts = len(mesh.vertices)
+    npolys = len(mesh.polygons)
+    nloops = len(mesh.loops)
+    coords = getcoordbuf(nverts)                            # all vertex coords
+    mesh.vertices.foreach_get("co", coords.ravel())
+    loopstart = np.empty(npolys, dtype=np.int32)            # polygons as runs of loops
+    mesh.polygons.foreach_get("loop_start", loopstart)
+    looptotal = np.empty(npolys, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", looptotal)
+    loopvert = np.empty(nloops, dtype=np.int32)             # vertex of each loop
+    mesh.loops.foreach_get("vertex_index", loopvert)
+    loopedge = np.empty(nloops, dtype=np.int32)             # edge of each loop
+    mesh.loops.foreach_get("edge_index", loopedge)
+    return (coords, loopstart, looptotal, loopvert, loopedge)
+
 #
 #   findrailingfaces -- find all faces with indicated material
 #
-def findrailingfaces(obj, materialix, plane, planeloc) :
+def findrailingfaces(obj, materialix, plane, planeloc, mesharrays=None) :
     '''
     Find all faces with indicated material and on + side of plane
+    
+    Mesh data is read in bulk with foreach_get and tested with Numba
+    if available, otherwise NumPy. A face is on the + side if all of
+    its vertices are. mesharrays is from getmesharrays, if the caller
+    has it.
     '''
-    return [face for face in obj.data.polygons 
-        if face.material_index == materialix
-        and positivesideofplane(obj, face, plane, planeloc)] 
+    mesh = obj.data
+    npolys = len(mesh.polygons)
+    if npolys == 0 :
+        return []
+    if mesharrays is None :
+        mesharrays = getmesharrays(mesh)
+    (coords, loopstart, looptotal, loopvert, loopedge) = mesharrays
+    plane = np.asarray(plane, dtype=np.float32)
+    planeloc = np.asarray(planeloc, dtype=np.float32)
+    materials = np.empty(npolys, dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", materials)
+    vertpositive = (coords - planeloc) @ plane > 0          # plane side of every vertex
+    if njit is not None and npolys >= NUMBAMINFACES :       # compiled kernel, worth its compile time
+        keep = np.empty(npolys, dtype=np.bool_)
+        facesonpositiveside(loopstart, looptotal, loopvert, vertpositive, materials, materialix, keep)
+    else :
+        #   Minimum over each polygon's run of loops is 1 only if every vertex is on the + side
+        polypositive = np.minimum.reduceat(vertpositive[loopvert].astype(np.int8), loopstart) > 0
+        keep = polypositive & (materials == materialix)
+    polys = mesh.polygons
+    return [polys[i] for i in np.flatnonzero(keep).tolist()]
 #
 #   equalizerailinguvs -- equalize UVs along length of railings
 #
-def equalizerailinguvs(obj) :
+def equalizerailinguvs(obj, groupmap=None) :
     '''
     Equalize UVs along length of railings.
     
     After we stretch, we need to equalize UVs so the railing animation looks right
+    
+    groupmap, from getgroupmap, is reused if the caller already has one.
+    Stretching does not change group membership.
     '''
+    groupsbyname = dict((vg.name, vg) for vg in obj.vertex_groups)  # vertex groups by name, built once
     #   Check that this object has a stretchable railing
     for (refname, plane, planeloc) in RAILINGS :            # for each railing vertex group
-        if not refname in obj.vertex_groups :               # can't find this vertex group
-            print("No vert group \"%s\" in \"%s\"." % (refname,obj.name))
+        if groupsbyname.get(refname) is None :              # can't find this vertex group
+            if DEBUG :
+                print("No vert group \"%s\" in \"%s\"." % (refname,obj.name))
             return
     #   Object OK for UV adjustment. Do it.
+    polyindex = getpolyindex(obj)                           # vertex set -> polygon, built once
+    if groupmap is None :
+        groupmap = getgroupmap(obj)                         # one scan for all railings
+    mesharrays = getmesharrays(obj.data)                    # coords and topology, shared by all railings
     for (refname, plane, planeloc) in RAILINGS :            # for each railing vertex group
-        if not refname in obj.vertex_groups :               # can't find this vertex group
+        vertgroup = groupsbyname.get(refname)               # got vertex group
+        if vertgroup is None :                              # can't find this vertex group
             raise ValueError("No vert group \"%s\" in \"%s\"." % (refname,obj.name))
-        vertgroup = obj.vertex_groups[refname]              # got vertex group
-        keyverts = getvertsingroup(obj, vertgroup)          # get verts of face
-        print("Railing %s: %d verts." % (refname, len(keyverts)))   # found relevant groups
-        keyface = findpolyfromvertices(obj,keyverts)         # look for verts
+        keyvertixs = groupmap.get(vertgroup.index, np.empty(0, dtype=np.int32)).tolist() # get verts of face
+        if DEBUG :
+            print("Railing %s: %d verts." % (refname, len(keyvertixs)))   # found relevant groups
+        keyface = findpolyfromvertices(obj,keyvertixs,polyindex) # look for verts
         if keyface is None :                                 # no find
             raise ValueError("Unable to find face that matches vertex group \"%s\"." % (refname,))
         materialix = keyface.material_index                 # get material index of key polygon
         material = obj.data.materials[materialix]           # the material
-        print("Key face material is %s" % (material.name,)) # ****TEMP***
-        faces = findrailingfaces(obj, materialix, plane, planeloc)
-        print("Found %d faces to equalize." % (len(faces),))
-        followquadsequalize(obj, keyface, faces)            # do the follow quads operation
+        if DEBUG :
+            print("Key face material is %s" % (material.name,)) # ****TEMP***
+        faces = findrailingfaces(obj, materialix, plane, planeloc, mesharrays)
+        if DEBUG :
+            print("Found %d faces to equalize." % (len(faces),))
+        if USEUVOPERATOR :
+            followquadsequalize(obj, keyface, faces, mesharrays)    # do the follow quads operation
+        else :
+            followquadsuvs(obj, keyface, faces, mesharrays)         # same result, computed directly
 
 #
 #   keyfacelengths -- get length of key face
 #
 #   The change in this during resizing controls scaling
 #
-def keyfacelengths(obj, keyface, teximageaspect) :
+def keyfacelengths(obj, keyface, teximageaspect, coords=None, uvs=None, loopvert=None) :
     '''
     Get lengths of key face. This is a rectangular quad, or should be
     
+    coords, uvs and loopvert are the whole-mesh arrays from foreach_get,
+    if the caller already has them; the key face is then gathered from
+    them by indexing. Otherwise it is read from the mesh.
+    
     Must be in OBJECT mode.
     '''
-    #   Lengths in 3D space
-    uvcoords = []                                               # UV coords in 2D space
-    vertcoords = []                                             # vertex coords in 3D space
-    for loopix in keyface.loop_indices :                        # for all edge loops
-        loop = obj.data.loops[loopix]                           # loop of interest
-        edge = obj.data.edges[loop.edge_index]                  # key vertex
-        uvcoords.append(obj.data.uv_layers.active.data[loopix].uv)   # UV coords of vertex for this edge
-        vertcoords.append(obj.data.vertices[loop.vertex_index].co)    # 3D coords of vertex for this edge
-        print("Vert: %s  Edge: %s  %s" % (obj.data.vertices[loop.vertex_index].co,obj.data.vertices[edge.vertices[0]].co , obj.data.vertices[edge.vertices[1]].co))
-    print("Vertex coords: %s" % (vertcoords,))
-    #   Lengths in 3D space, wrapping around
-    longside = 0.0
-    shortside = float('inf')
-    for i in range(len(vertcoords)) :
-        length = (vertcoords[i] - vertcoords[(i+1) % len(vertcoords)]).length
-        longside = max(length, longside)                        # keep longest length
-        shortside = min(length, shortside)                      # keep shortest length
-
-    #   Lengths in UV space, wrapping around
-    longuvside = 0.0
-    shortuvside = float('inf')
-    for i in range(len(uvcoords)) :
-        length = (uvcoords[i] - uvcoords[(i+1) % len(uvcoords)]).length
-        longuvside = max(length, longuvside)                    # keep longest length
-        shortuvside = min(length, shortuvside)                  # keep shortest length
+    #   Gather the key face's vertex and UV coords, in loop order
+    if coords is not None :
+        keyloops = np.arange(keyface.loop_start, keyface.loop_start + keyface.loop_total)
+        vertcoords = coords[loopvert[keyloops]]
+        uvcoords = uvs[keyloops]
+    else :
+        mesh = obj.data
+        uvdata = mesh.uv_layers.active.data
+        vertcoords = np.array([mesh.vertices[mesh.loops[loopix].vertex_index].co[:] for loopix in keyface.loop_indices], dtype=np.float32)
+        uvcoords = np.array([uvdata[loopix].uv[:] for loopix in keyface.loop_indices], dtype=np.float32)
+    if DEBUG :
+        print("Vertex coords: %s" % (vertcoords,))
+    #   Side lengths in 3D and UV space, wrapping around
+    vertlengths = np.linalg.norm(vertcoords - np.roll(vertcoords, -1, axis=0), axis=1)
+    uvlengths = np.linalg.norm(uvcoords - np.roll(uvcoords, -1, axis=0), axis=1)
+    longside = float(vertlengths.max())
+    shortside = float(vertlengths.min())
+    longuvside = float(uvlengths.max())
+    shortuvside = float(uvlengths.min())
 
     ####for vert_idx, loop_idx in zip(keyface.vertices, keyface.loop_indices):
     ####    uv_coords = obj.data.uv_layers.active.data[loop_idx].uv
@@ -194,13 +299,134 @@ def keyfacelengths(obj, keyface, teximageaspect) :
     vertratio = longside / shortside
     uvratio = longuvside / shortuvside
     uvrescale = (vertratio / uvratio) / teximageaspect          # calculate X rescale factor to make model match image
-    print("Face ratios: verts %1.4f UVs %1.4f  UV rescale needed: %1.4f" % (vertratio, uvratio, uvrescale,))
+    if DEBUG :
+        print("Face ratios: verts %1.4f UVs %1.4f  UV rescale needed: %1.4f" % (vertratio, uvratio, uvrescale,))
     return uvrescale                                            # apply this rescale factor to X axis of UVs
             
+#
+#   getteximageaspect -- aspect ratio of the key face's texture image
+#
+def getteximageaspect(obj, keyface) :
+    '''
+    Get X/Y aspect ratio of first texture image of key face's material.
+    
+    1.0 if there is no image.
+    '''
+    teximageaspect = 1.0                                        # texture image aspect ratio
+    materialix = keyface.material_index                         # get material index of key polygon
+    material = obj.data.materials[materialix]                   # the material. Must have material to get here
+    if DEBUG :
+        print("Key face material is %s" % (material.name,))         # ****TEMP***
+    #   Get aspect ratio from first texture image for this material
+    if material and material.use_nodes :                        # if we have a material
+        for node in material.node_tree.nodes:                   # look through node tree for image
+            if node.type == 'TEX_IMAGE' :
+                if node.image.size[0] > 0 or node.image.size[1] > 0 :
+                    if DEBUG :
+                        print(' uses', node.image.name, 'x',node.image.size[0], 'y',node.image.size[1])
+                    teximageaspect = node.image.size[0] / node.image.size[1]    # image aspect ratio X/Y
+    return teximageaspect
+    
+#
+#   followquadsuvs -- "follow active quads" computed directly on mesh arrays
+#
+def followquadsuvs(obj, keyface, faces, mesharrays=None) :
+    '''
+    Equalize UVs of faces the way "follow active quads" in LENGTH mode
+    does, then rescale X to match the texture.
+    
+    Walks outward from keyface across shared, manifold, non-seam edges,
+    extrapolating each new quad's UVs from the quad it was reached from,
+    scaled by the ratio of 3D edge lengths. Mesh data is read with
+    foreach_get, or taken from mesharrays (see getmesharrays), and UVs
+    written back with one foreach_set, so there are no mode switches,
+    no bmesh and no operator.
+    
+    Must be in OBJECT mode. Caller must call obj.data.update() afterwards.
+    '''
+    if keyface.loop_total != 4 :
+        raise ValueError("Railing key face #%d is not a quad." % (keyface.index,))
+    teximageaspect = getteximageaspect(obj, keyface)
+    mesh = obj.data
+    if mesharrays is None :
+        mesharrays = getmesharrays(mesh)
+    (coords, _, _, loopvert, loopedge) = mesharrays
+    nloops = len(mesh.loops)
+    uvdata = mesh.uv_layers.active.data
+    uvs = np.empty(nloops*2, dtype=np.float32)
+    uvdata.foreach_get("uv", uvs)
+    uvs = uvs.reshape(nloops,2)
+    seams = np.empty(len(mesh.edges), dtype=bool)
+    mesh.edges.foreach_get("use_seam", seams)
+    edgeusers = np.bincount(loopedge, minlength=len(mesh.edges))   # 2 for manifold edges
+    resizex = keyfacelengths(obj, keyface, teximageaspect, coords, uvs, loopvert)    # before the key face's neighbors change
+    loopvert = loopvert.tolist()                                # plain ints for the walk
+    loopedge = loopedge.tolist()
+    #   Loops of the quads to equalize, by edge
+    loopstart = {}                                              # face index -> first loop
+    edgeloops = {}                                              # edge index -> [(loop, face)]
+    for face in faces :
+        if face.loop_total != 4 :                               # only quads are followed
+            continue
+        loopstart[face.index] = face.loop_start
+        for loopix in range(face.loop_start, face.loop_start+4) :
+            edgeloops.setdefault(loopedge[loopix], []).append((loopix, face.index))
+    def nextloop(loopix, faceix) :                              # next loop around a quad
+        start = loopstart[faceix]
+        return start + (loopix - start + 1) % 4
+    #   Walk outward from the key face, breadth first
+    loopstart.setdefault(keyface.index, keyface.loop_start)
+    done = set([keyface.index])
+    front = [keyface.index]
+    while front :
+        nextfront = []
+        for faceix in front :
+            for loopix in range(loopstart[faceix], loopstart[faceix]+4) :
+                edgeix = loopedge[loopix]
+                if edgeusers[edgeix] != 2 or seams[edgeix] :    # don't cross seams or non-manifold edges
+                    continue
+                for (otherloopix, otherfaceix) in edgeloops.get(edgeix, ()) :
+                    if otherfaceix in done :
+                        continue
+                    #   Loops of this face, starting at the shared edge
+                    a0 = loopix
+                    a1 = nextloop(a0, faceix)
+                    a2 = nextloop(a1, faceix)
+                    a3 = nextloop(a2, faceix)
+                    #   Loops of the other face, b0 and b1 at the same verts as a0 and a1
+                    if loopvert[otherloopix] != loopvert[loopix] :
+                        b1 = otherloopix
+                        b0 = nextloop(b1, otherfaceix)
+                        b3 = nextloop(b0, otherfaceix)
+                        b2 = nextloop(b3, otherfaceix)
+                    else :
+                        b0 = otherloopix
+                        b1 = nextloop(b0, otherfaceix)
+                        b2 = nextloop(b1, otherfaceix)
+                        b3 = nextloop(b2, otherfaceix)
+                    #   Length ratio of new quad to old, along the walk direction
+                    (va0, va1, va2, va3) = coords[[loopvert[a0], loopvert[a1], loopvert[a2], loopvert[a3]]]
+                    (vb2, vb3) = coords[[loopvert[b2], loopvert[b3]]]
+                    d1 = np.linalg.norm(va3 - va0) + np.linalg.norm(va2 - va1)
+                    d2 = np.linalg.norm(va0 - vb3) + np.linalg.norm(va1 - vb2)
+                    fac = d2 / d1 if d1 > 0.0 else 1.0
+                    #   Extrapolate UVs across the shared edge
+                    uvs[b0] = uvs[a0]
+                    uvs[b3] = uvs[a0] + (uvs[a0] - uvs[a3]) * fac
+                    uvs[b1] = uvs[a1]
+                    uvs[b2] = uvs[a1] + (uvs[a1] - uvs[a2]) * fac
+                    done.add(otherfaceix)
+                    nextfront.append(otherfaceix)
+        front = nextfront
+    #   Scale UVs to fit, like scaleuvs
+    faceloops = [loopix for face in faces for loopix in face.loop_indices]
+    uvs[faceloops, 0] *= resizex
+    uvdata.foreach_set("uv", uvs.ravel())                      # caller does mesh.update()
+
 #
 #   followquadsequalize
 #
-def followquadsequalize(obj, keyface, faces) :
+def followquadsequalize(obj, keyface, faces, mesharrays=None) :
     '''
     Do a "follow active quads".
     
@@ -213,34 +439,34 @@ def followquadsequalize(obj, keyface, faces) :
     '''
     prevmode = bpy.context.mode                                 # for later restoration
     try :
-        #   Find image being used for texture, to get its aspect ratio
-        teximageaspect = 1.0                                    # texture image aspect ratio
-        materialix = keyface.material_index                     # get material index of key polygon
-        material = obj.data.materials[materialix]               # the material. Must have material to get here
-        print("Key face material is %s" % (material.name,))     # ****TEMP***
-        #   Get aspect ratio from first texture image for this material
-        if material and material.use_nodes :                    # if we have a material
-            for node in material.node_tree.nodes:               # look through node tree for image
-                if node.type == 'TEX_IMAGE' :
-                    if node.image.size[0] > 0 or node.image.size[1] > 0 :
-                        print(' uses', node.image.name, 'x',node.image.size[0], 'y',node.image.size[1])
-                        teximageaspect = node.image.size[0] / node.image.size[1]    # image aspect ratio X/Y
+        teximageaspect = getteximageaspect(obj, keyface)        # texture image aspect ratio
         #   Get all faces to be equalized selected. Key face to follow is the active face
         bpy.ops.object.mode_set(mode='OBJECT', toggle=False)    # strangely, we have to select faces in object mode
-        #   Deselect all mesh elements of the object
-        for vertex in obj.data.vertices :
-            vertex.select = False
-        for edge in obj.data.edges :
-            edge.select = False
-        for face in obj.data.polygons.values() :
-            face.select = False                                 # deselect 
-        #   Select faces of interest and key face
-        for face in faces :                                     # for all faces
-            face.select = True                                  # select face
-            for loopix in face.loop_indices :                   # for all edge loops
-                loop = obj.data.loops[loopix]                   # loop of interest
-                obj.data.vertices[loop.vertex_index].select = True   # select vertex
-                obj.data.edges[loop.edge_index].select = True        # select edges
+        #   The key face's UVs are not changed by follow active quads, so the
+        #   rescale factor can be found now, from the mesh, in object mode.
+        resizex = keyfacelengths(obj,keyface, teximageaspect)   # get lengths of key face
+        if DEBUG :
+            print("Key face lengths: %s" % (resizex,))          # ***TEMP***
+        #   Deselect all mesh elements of the object, then select faces of interest
+        #   and their verts and edges. Selection masks are built in NumPy and
+        #   written with one foreach_set per element type.
+        mesh = obj.data
+        if mesharrays is None :
+            mesharrays = getmesharrays(mesh)
+        (_, loopstart, looptotal, loopvert, loopedge) = mesharrays  # same arrays as the plane test used
+        faceixs = np.array([face.index for face in faces], dtype=np.int32)
+        totals = looptotal[faceixs]                             # loops of each selected face
+        firsts = np.cumsum(totals) - totals                     # where each face's run starts in the output
+        selloops = np.repeat(loopstart[faceixs] - firsts, totals) + np.arange(totals.sum())   # all loops of selected faces
+        vertsel = np.zeros(len(mesh.vertices), dtype=bool)
+        vertsel[loopvert[selloops]] = True
+        edgesel = np.zeros(len(mesh.edges), dtype=bool)
+        edgesel[loopedge[selloops]] = True
+        facesel = np.zeros(len(mesh.polygons), dtype=bool)
+        facesel[faceixs] = True
+        mesh.vertices.foreach_set("select", vertsel)
+        mesh.edges.foreach_set("select", edgesel)
+        mesh.polygons.foreach_set("select", facesel)
        
         #   Make the key face the active face. 
         #   Per https://blender.stackexchange.com/questions/81395/python-set-active-face-batch-unwrap-follow-active-quads
@@ -252,16 +478,13 @@ def followquadsequalize(obj, keyface, faces) :
 
         #   Equalize the UVs
         bpy.ops.uv.follow_active_quads(mode='LENGTH')           # equalize UVs
-        #   Done
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)    # back to object mode
-        bm.free()                                               # done with bmesh
-        #   Scale UVs to fit
-        resizex = keyfacelengths(obj,keyface, teximageaspect)# get lengths of key face
-        print("Key face lengths: %s" % (resizex,))              # ***TEMP***
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)      # must be in edit mode for bmesh work
-        bm = bmesh.from_edit_mesh(obj.data)                     # get a working bmesh
+        #   Scale UVs to fit, still in the same edit session, so the mesh
+        #   is converted to and from bmesh only once.
+        bm = bmesh.from_edit_mesh(obj.data)                     # edit bmesh as the operator left it
         scaleuvs(obj, bm, faces, Vector([resizex, 1.0]))        # rescale UV of indicated faces
-        print("Key face #%d" % (keyface.index,))                # ***TEMP***
+        bmesh.update_edit_mesh(obj.data, True)                  # push changes to edit mesh
+        if DEBUG :
+            print("Key face #%d" % (keyface.index,))                # ***TEMP***
     finally:
         bpy.ops.object.mode_set(mode='OBJECT', toggle=False)    # back to object mode
         pass #### bpy.ops.object.mode_set(mode=prevmode, toggle=False)    # return to previous mode
@@ -282,64 +505,120 @@ def scaleuvs(obj, bm, faces, scale) :
             l[uv_layer].uv = Vector([l[uv_layer].uv[i]*scale[i] for i in range(len(scale))] )   # elementwise mult
 
 #
-#   getvertsingroup --  get vertices in given group
+#   getvertindicesingroup --  get indices of vertices in given group
 #
-def getvertsingroup(obj, groupobj) :
+def getvertindicesingroup(obj, groupobj) :
     """
-    Get vertices by vertex group
+    Get indices of vertices in a vertex group, as a NumPy array.
+    
+    Membership is tested on a bmesh deform layer, where "in" is a hashed
+    lookup, rather than by walking each MeshVertex.groups in Python.
     """
     groupix = groupobj.index                    # group index
-    ####print("Verts of index %d, group %s, object %s" % (groupix, groupobj.name, obj.name)) # ***TEMP***
-    verts = []                                  # array of verts
-    for v in obj.data.vertices :                # search for vert in group
-        for g in v.groups :
-            if g.group == groupix :             # Yes, O(N*M), but M is tiny
-                verts.append(v)
-    return verts
+    bm = bmesh.new()
+    try :
+        bm.from_mesh(obj.data)
+        deform = bm.verts.layers.deform.active  # None if no vertex has any group
+        if deform is None :
+            return np.empty(0, dtype=np.int32)
+        return np.fromiter((vertix for (vertix, v) in enumerate(bm.verts) if groupix in v[deform]), dtype=np.int32)
+    finally :
+        bm.free()
+    
+#
+#   getgroupmap -- map every vertex group to the indices of its vertices
+#
+def getgroupmap(obj) :
+    """
+    Build {group index: array of vertex indices} in one pass over the verts.
+    
+    Membership comes from a bmesh deform layer, where each vertex's group
+    indices are one keys() call, rather than from MeshVertex.groups,
+    which makes a Python object per group entry.
+    The (vertex, group) pairs are flattened CSR style and grouped with
+    a stable sort, so vertex indices stay ascending within each group.
+    Use when several groups of the same mesh are needed.
+    """
+    bm = bmesh.new()
+    try :
+        bm.from_mesh(obj.data)
+        deform = bm.verts.layers.deform.active  # None if no vertex has any group
+        if deform is None :
+            return {}
+        keylists = [v[deform].keys() for v in bm.verts]    # single pass over verts, in mesh order
+    finally :
+        bm.free()
+    counts = np.fromiter(map(len, keylists), dtype=np.int32, count=len(keylists))  # groups per vertex
+    groupixs = np.fromiter(itertools.chain.from_iterable(keylists), dtype=np.int32, count=int(counts.sum()))
+    vertixs = np.repeat(np.arange(len(keylists), dtype=np.int32), counts)  # vertex of each pair
+    order = np.argsort(groupixs, kind='stable')
+    groupixs = groupixs[order]
+    vertixs = vertixs[order]
+    starts = np.flatnonzero(np.diff(groupixs, prepend=-1))  # first pair of each group
+    return dict(zip(groupixs[starts].tolist(), np.split(vertixs, starts[1:])))
     
 #
 #   stretchmodel -- stretch selected model appropriately
 #
-def stretchmodel(target, topname, stretchvec) :
+def stretchmodel(target, topname, stretchvec, coords=None, groupmap=None) :
     """
     Stretch selected model along vector from bottom ref to top ref.
     
     dist is the desired distance between bottom ref and top ref
+    
+    coords, if given, is the caller's (N,3) float32 copy of the vertex
+    coords. It is used instead of reading the mesh, and is updated in place.
+    groupmap, from getgroupmap, saves rescanning the mesh for the Top group.
+    
+    Returns False, without touching the mesh, if there is nothing to move.
+    Otherwise the caller must call target.data.update() once it has
+    finished writing to the mesh.
     """
     #   Sanity checks before starting
     if target.type != 'MESH' :
         raise ValueError("Selected object \"%s\" must be a mesh." % (target.name,))
-    if target.scale[0] < 0 or target.scale[1] < 0 or target.scale[2] < 0 :
+    scale = target.scale[:]                                 # read once
+    if min(scale) < 0 :
         raise ValueError("Selected object \"%s\" has a negative scale:  (%1.2f, %1.2f, %1.2f)." % 
-                (target.name, target.scale[0], target.scale[1], target.scale[2]))
+                (target.name, scale[0], scale[1], scale[2]))
+    if stretchvec.length < MINSTRETCH :                         # already the requested size
+        return False
                 
     #   Find relevant vertex groups
-    ####toprefv = getrefvertcoords(reftarget, toprefname)
-    ####bottomrefv = getrefvertcoords(reftarget, bottomrefname)
     topgroup = target.vertex_groups[topname]
-    topvs = getvertsingroup(target, topgroup)               # verts to move
-    ####refvec = toprefv.co - bottomrefv.co                     # movement direction
-    ####print("object: %s  topref: %s  bottomref: %s  refvec: %s" % (target.name, toprefv.co, bottomrefv.co, refvec))    # ***TEMP***
-    ####if refvec.magnitude < 0.001 :
-    ####    raise ValueError("Reference vertices are in the same place.")
-    ####refvecnorm = refvec.normalized()                        # unit vector
+    if groupmap is None :
+        topix = getvertindicesingroup(target, topgroup)     # indices of verts to move
+    else :
+        topix = groupmap.get(topgroup.index, np.empty(0, dtype=np.int32))
     #   All checks passed. OK to perform stretch.
-    print("Stretching %s by %s" % (target.name, stretchvec))
-    #   Move verts
-    for v in topvs :
-        v.co = v.co + stretchvec
+    if DEBUG :
+        print("Stretching %s by %s" % (target.name, stretchvec))
+    #   Move verts. Bulk read, vectorized add, bulk write.
+    mesh = target.data
+    if coords is None :
+        coords = getcoordbuf(len(mesh.vertices))
+        mesh.vertices.foreach_get("co", coords.ravel())
+    if abs(stretchvec.x) < 1e-9 and abs(stretchvec.y) < 1e-9 :  # straight up, the usual case
+        coords[topix,2] += stretchvec.z                      # Z column only
+    else :
+        coords[topix] += np.asarray(stretchvec, dtype=np.float32)
+    mesh.vertices.foreach_set("co", coords.ravel())           # caller does mesh.update()
+    return True
     
-def getrefvertcoords(obj, refname) :
+def getrefvertindex(obj, refname, groupmap=None) :
     """
-    Get coordinates of a single vertex group
+    Get index of the single vertex of a vertex group
     """
-    if not refname in obj.vertex_groups :
+    refgroup = obj.vertex_groups.get(refname)      # one name lookup, not two
+    if refgroup is None :
         raise ValueError("Cannot find vertex group \"%s\" in \"%s\"." % (refname,obj.name))
-    refgroup = obj.vertex_groups[refname]
-    refverts = getvertsingroup(obj, refgroup)
-    if len(refverts) != 1 : 
-        raise ValueError("Reference vertex group \"%s\" had %d vertices, not one." % (refname,len(refverts)))
-    return refverts[0]                              # return the only vert
+    if groupmap is None :
+        refixs = getvertindicesingroup(obj, refgroup)
+    else :
+        refixs = groupmap.get(refgroup.index, ())
+    if len(refixs) != 1 : 
+        raise ValueError("Reference vertex group \"%s\" had %d vertices, not one." % (refname,len(refixs)))
+    return int(refixs[0])                           # index of the only vert
    
         
 #
@@ -360,7 +639,8 @@ class AskSizeDialogOperator(bpy.types.Operator):
 
 
     def run(self, context):
-        print("Dialog result: %1.2f" % (self.desired_height,))
+        if DEBUG :
+            print("Dialog result: %1.2f" % (self.desired_height,))
         if self.desired_height < 0.1 or self.desired_height > 64.0 :
             return({'ERROR_INVALID_INPUT'}, "Desired height %1.3f out of range." % (self.desired_height))      
         if not context.selected_objects :
@@ -376,28 +656,47 @@ class AskSizeDialogOperator(bpy.types.Operator):
                     if collobj.type != 'MESH' :     # meshes only
                         continue
                     if not collobj in targetset :   # if new member
-                        print("Additional target: %s from collection %s" % (collobj.name,coll.name))
+                        if DEBUG :
+                            print("Additional target: %s from collection %s" % (collobj.name,coll.name))
                         targetset.add(collobj)      # add to target set
         
         try :                                       # do the work
             #   Calculate how much to stretch to get desired height between platform ref points
-            print("Ref target is %s." % reftarget.name)
-            oldheight = getrefvertcoords(reftarget, PLATTOP).co.z - getrefvertcoords(reftarget, PLATBOTTOM).co.z  # previous height
+            if DEBUG :
+                print("Ref target is %s." % reftarget.name)
+            groupmap = getgroupmap(reftarget)           # one scan for all ref points
+            plattopix = getrefvertindex(reftarget, PLATTOP, groupmap)
+            platbottomix = getrefvertindex(reftarget, PLATBOTTOM, groupmap)
+            reftopix = getrefvertindex(reftarget, REFTOP, groupmap)
+            refbottomix = getrefvertindex(reftarget, REFBOTTOM, groupmap)
+            nrefverts = len(reftarget.data.vertices)
+            refcoords = np.empty(nrefverts*3, dtype=np.float32) # all ref target coords, read once
+            reftarget.data.vertices.foreach_get("co", refcoords)
+            refcoords = refcoords.reshape(nrefverts,3)
+            oldheight = float(refcoords[plattopix,2] - refcoords[platbottomix,2])  # previous height
             zchange = self.desired_height - oldheight        # need to change Z by this much
-            oldstretchvec = getrefvertcoords(reftarget, REFTOP).co - getrefvertcoords(reftarget, REFBOTTOM).co    # previous stretch vector
-            newstretchvec = oldstretchvec * ((oldstretchvec.z + zchange) / oldstretchvec.z)                 # desired stretch vector
-            dist = newstretchvec.magnitude - oldstretchvec.magnitude    # distance to add to stretch vector
-            toprefv = getrefvertcoords(reftarget, REFTOP)
-            bottomrefv = getrefvertcoords(reftarget, REFBOTTOM)
-            refvec = toprefv.co - bottomrefv.co                         # movement direction
+            oldstretchvec = Vector(refcoords[reftopix] - refcoords[refbottomix])  # previous stretch vector
+            refvec = oldstretchvec                                      # movement direction
             if refvec.magnitude < 0.001 :
                 raise ValueError("Reference vertices are in the same place.")
+            dist = oldstretchvec.length * zchange / oldstretchvec.z     # distance to add along stretch vector
+            stretchvec = refvec.normalized() * dist                     # same move for every target
+            stretching = stretchvec.length >= MINSTRETCH                   # else stretchmodel only checks
             for target in targetset:
                 if target.type == 'MESH' : 
-                    stretchmodel(target, VERTSTOP, dist*refvec.normalized())    # stretch
-                    equalizerailinguvs(target)                                  # equalize UVs
-            #   Checking
-            finalheight = getrefvertcoords(reftarget, PLATTOP).co.z - getrefvertcoords(reftarget, PLATBOTTOM).co.z    # final height
+                    if target == reftarget :                                    # keep refcoords current
+                        targetgroupmap = groupmap
+                        moved = stretchmodel(target, VERTSTOP, stretchvec, refcoords, groupmap)
+                    else :
+                        targetgroupmap = getgroupmap(target) if stretching else None  # Top and railings, one scan
+                        moved = stretchmodel(target, VERTSTOP, stretchvec, None, targetgroupmap)  # stretch
+                    if moved :                                                  # UVs unchanged if nothing moved
+                        try :
+                            equalizerailinguvs(target, targetgroupmap)          # equalize UVs
+                        finally :
+                            target.data.update()                                # one update for all bulk writes, even on error
+            #   Checking, from the same coords that were written to the mesh
+            finalheight = float(refcoords[plattopix,2] - refcoords[platbottomix,2])    # final height
             if abs(finalheight - self.desired_height) > 0.01 :
                 raise ValueError("Model error: height %1.3f after stretching does not match goal of %1.3f" % (finalheight, self.desired_height))
             
@@ -411,7 +710,23 @@ class AskSizeDialogOperator(bpy.types.Operator):
         return wm.invoke_props_dialog(self)
 
 
-bpy.utils.register_class(AskSizeDialogOperator)
+#
+#   register, unregister -- operator registration
+#
+#   The script is re-run with exec() during development, and each run defines a
+#   new class.  Take out the one registered by an earlier run, so there is only
+#   ever one, and it is the current code.
+#
+def register() :
+    if hasattr(bpy.types, 'OBJECT_OT_ask_size_dialog_operator') :  # from a previous run
+        unregister()
+    bpy.utils.register_class(AskSizeDialogOperator)
+
+def unregister() :
+    bpy.utils.unregister_class(bpy.types.OBJECT_OT_ask_size_dialog_operator)
+
+
+register()
 
 #   Call this to use.
 def linearstretch() :
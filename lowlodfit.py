@@ -7,8 +7,8 @@
 #   December, 2018
 #   License: GPL
 #
-#   This stretches a low-LOD model (the selected object)
-#   to match the bounds of a high-LOD model.
+#   This stretches a low-LOD model to match the bounds of
+#   a high-LOD model (each selected object).
 #
 #   Used to adjust the low-LOD model of the escalator steps.
 #   The high-LOD model is an array, where then number of
@@ -31,7 +31,16 @@
 #       Make sure scale is 1, or fix to be scale-independent.
 #
 import bpy
+import bmesh
 import math
+import numpy as np
+try :
+    from numba import njit, prange                          # optional; compiles the numeric kernel
+except ImportError :
+    njit = None                                             # not installed, use the NumPy path
+    prange = range
+DEBUG = False                                               # True for diagnostic prints
+NUMBAMINVERTS = 100000                                      # use the Numba kernel only on meshes at least this big
 #
 #   Names of vertex groups in model.
 #   Model must use these.
@@ -45,20 +54,46 @@ PLATTOP = "Top platform"
 PLATBOTTOM = "Bottom platform"
 
 #
-#   getvertsingroup --  get vertices in given group
+#   getvertindicesingroup --  get indices of vertices in given group
 #
-def getvertsingroup(obj, groupobj) :
+def getvertindicesingroup(obj, groupobj) :
     """
-    Get vertices by vertex group
+    Get indices of vertices in a vertex group, as a NumPy array.
+    
+    Membership is tested on a bmesh deform layer, where "in" is a hashed
+    lookup, rather than by walking each MeshVertex.groups in Python.
     """
     groupix = groupobj.index                    # group index
-    ####print("Verts of index %d, group %s, object %s" % (groupix, groupobj.name, obj.name)) # ***TEMP***
-    verts = []                                  # array of verts
-    for v in obj.data.vertices :                # search for vert in group
-        for g in v.groups :
-            if g.group == groupix :             # Yes, O(N*M), but M is tiny
-                verts.append(v)
-    return verts
+    bm = bmesh.new()
+    try :
+        bm.from_mesh(obj.data)
+        deform = bm.verts.layers.deform.active  # None if no vertex has any group
+        if deform is None :
+            return np.empty(0, dtype=np.int32)
+        return np.fromiter((vertix for (vertix, v) in enumerate(bm.verts) if groupix in v[deform]), dtype=np.int32)
+    finally :
+        bm.free()
+    
+#
+#   getcoords, setcoords -- bulk vertex coordinate transfer
+#
+def getcoords(mesh) :
+    """
+    Read all vertex coords with one foreach_get, as an (N,3) float32 array.
+    
+    All coordinate work is done on this array, not on per-vertex Vectors.
+    """
+    n = len(mesh.vertices)
+    coords = np.empty(n*3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    return coords.reshape(n,3)
+    
+def setcoords(mesh, coords) :
+    """
+    Write an (N,3) float32 array from getcoords back to the mesh.
+    """
+    mesh.vertices.foreach_set("co", coords.ravel())
+    mesh.update()
     
 #
 #   stretchmodel -- stretch selected model appropriately
@@ -72,112 +107,142 @@ def stretchmodel(target, topname, stretchvec) :
     #   Sanity checks before starting
     if target.type != 'MESH' :
         raise ValueError("Selected object \"%s\" must be a mesh." % (target.name,))
-    if target.scale[0] < 0 or target.scale[1] < 0 or target.scale[2] < 0 :
+    scale = target.scale[:]                                 # read once
+    if min(scale) < 0 :
         raise ValueError("Selected object \"%s\" has a negative scale:  (%1.2f, %1.2f, %1.2f)." % 
-                (target.name, target.scale[0], target.scale[1], target.scale[2]))
+                (target.name, scale[0], scale[1], scale[2]))
+    if stretchvec.length < 1e-6 :                           # already the requested size
+        return
                 
     #   Find relevant vertex groups
-    ####toprefv = getrefvertcoords(reftarget, toprefname)
-    ####bottomrefv = getrefvertcoords(reftarget, bottomrefname)
     topgroup = target.vertex_groups[topname]
-    topvs = getvertsingroup(target, topgroup)               # verts to move
-    ####refvec = toprefv.co - bottomrefv.co                     # movement direction
-    ####print("object: %s  topref: %s  bottomref: %s  refvec: %s" % (target.name, toprefv.co, bottomrefv.co, refvec))    # ***TEMP***
-    ####if refvec.magnitude < 0.001 :
-    ####    raise ValueError("Reference vertices are in the same place.")
-    ####refvecnorm = refvec.normalized()                        # unit vector
+    topix = getvertindicesingroup(target, topgroup)         # indices of verts to move
     #   All checks passed. OK to perform stretch.
-    print("Stretching %s by %s" % (target.name, stretchvec))
-    #   Move verts
-    for v in topvs :
-        v.co = v.co + stretchvec
+    if DEBUG :
+        print("Stretching %s by %s" % (target.name, stretchvec))
+    #   Move verts. Bulk read, vectorized add, bulk write.
+    coords = getcoords(target.data)
+    coords[topix] += np.asarray(stretchvec, dtype=np.float32)
+    setcoords(target.data, coords)
     
 def getrefvertcoords(obj, refname) :
     """
     Get coordinates of a single vertex group
     """
-    if not refname in obj.vertex_groups :
+    refgroup = obj.vertex_groups.get(refname)      # one name lookup, not two
+    if refgroup is None :
         raise ValueError("Cannot find vertex group \"%s\"." % (refname,))
-    refgroup = obj.vertex_groups[refname]
-    refverts = getvertsingroup(obj, refgroup)
-    if len(refverts) != 1 : 
-        raise ValueError("Reference vertex group \"%s\" had %d vertices, not one." % (refname,len(refverts)))
-    return refverts[0]                              # return the only vert
+    refixs = getvertindicesingroup(obj, refgroup)
+    if len(refixs) != 1 : 
+        raise ValueError("Reference vertex group \"%s\" had %d vertices, not one." % (refname,len(refixs)))
+    return obj.data.vertices[int(refixs[0])]        # return the only vert
     
-def adjustboundboxes(target) :
+def adjustboundboxes(target, matches=None) :
     '''
     Adjust second object to match bounding box of first
+    
+    matches is findlowlodmatch(target), if the caller already has it.
     '''
-    matches = findlowlodmatch(target)
+    if matches is None :
+        matches = findlowlodmatch(target)
     if len(matches) != 1 :
         raise ValueError("No unique matching lower LOD mesh for: " + target.name)
     lowlodobj = matches[0]                              # will adjust this object
     resizetomatchboundboxes(target, lowlodobj)
     return 
     
-def bbrange(bblist) :
-    '''
-    Take in list of bounding box points, return Vector(dx,dy,dz) indicating range
+def bbminmax(bblist) :
     '''
-    return Vector(
-        [max([pnt[i] for pnt in bblist])-min([pnt[i] for pnt in bblist]) for i in range(3)]) 
-        
-def bbcenter(bblist) :
-    '''
-    Take in list of bounding box points, return Vector(dx,dy,dz) indicating center
+    Take in list of bounding box points, return (min, max) arrays over all of them
+    
+    Range and center both come from this one pair of reductions.
     '''
-    return Vector(
-        [max([pnt[i] for pnt in bblist])+min([pnt[i] for pnt in bblist]) for i in range(3)])*0.5     
+    bbarray = np.array([pnt[:] for pnt in bblist], dtype=np.float32)   # (8,3) corners
+    return (np.minimum.reduce(bbarray, axis=0), np.maximum.reduce(bbarray, axis=0))
     
 def resizetomatchboundboxes(hilodobj,lolodobj) :
     '''
     Adjust second object to match bounding box of first
     '''
-    boundshi = hilodobj.bound_box                       # get bounding box
-    for bnd in boundshi :
-        print("Corner: <%f %f %f>" % (bnd[0],bnd[1],bnd[2]))                    # ***TEMP***
-    hirange = bbrange(hilodobj.bound_box)
-    lorange = bbrange(lolodobj.bound_box)
+    if DEBUG :
+        for bnd in hilodobj.bound_box :
+            print("Corner: <%f %f %f>" % (bnd[0],bnd[1],bnd[2]))                    # ***TEMP***
+    (himin, himax) = bbminmax(hilodobj.bound_box)      # each bound box read once
+    (lomin, lomax) = bbminmax(lolodobj.bound_box)
+    hirange = himax-himin
+    lorange = lomax-lomin
     stretch = hirange-lorange                           # how much we have to stretch
-    print("Hi Range: " + str(hirange))                                # ***TEMP***
-    print("Lo Range: " + str(lorange))                                    # ***TEMP***
-    print("Stretch: " + str(stretch))
+    if DEBUG :
+        print("Hi Range: " + str(hirange))                                # ***TEMP***
+        print("Lo Range: " + str(lorange))                                # ***TEMP***
+        print("Stretch: " + str(stretch))
     #  Find which vertices need stretching
-    planeloc = Vector([0,0,0])                          # relative to object center
-    planeloc = bbcenter(lolodobj.bound_box)             # center of object being modified
-    plane = Vector([0,1,-1])                            # direction to look for points to stretch ***TEMP***
-    stretch = Vector([plane[i]*stretch[i] for i in range(3)])   # elementwise mult ***TEMP**
-    verts = findvertstostretch(lolodobj, plane, planeloc)
-    print("Verts: " + str([v.co for v in verts]))
+    planeloc = (lomax+lomin)*0.5                        # center of object being modified
+    plane = np.array([0,1,-1], dtype=np.float32)        # direction to look for points to stretch ***TEMP***
+    stretch = plane*stretch                             # elementwise mult ***TEMP**
+    if np.abs(stretch).max() < 1e-6 :                   # bound boxes already match
+        return
+    coords = getcoords(lolodobj.data)                   # read once, for the plane test and the move
+    vertixs = findvertstostretch(lolodobj, plane, planeloc, coords)
     #   All checks passed. OK to perform stretch.
-    print("Stretching %s by %s" % (lolodobj.name, stretch))
-    #   Move verts
-    for v in verts :
-        v.co = v.co + stretch 
+    if DEBUG :
+        print("Verts to stretch: %d of %d" % (len(vertixs), len(coords)))
+        print("Stretching %s by %s" % (lolodobj.name, stretch))
+    #   Move verts. Vectorized add, bulk write.
+    coords[vertixs] += stretch
+    setcoords(lolodobj.data, coords)
     
-def findvertstostretch(obj, plane, planeloc) :
+#
+#   vertsonpositiveside -- numeric kernel for findvertstostretch
+#
+def vertsonpositiveside(coords, planeloc, plane, out) :
+    '''
+    Set out[i] for vertices on the + side of the plane, or on it.
+    
+    Subtract, dot and compare in one pass, with no (N,3) temporary.
+    Only loops over NumPy arrays, no Blender calls, so Numba can compile it.
+    '''
+    for i in prange(coords.shape[0]) :
+        out[i] = ((coords[i,0]-planeloc[0])*plane[0] + (coords[i,1]-planeloc[1])*plane[1]
+                + (coords[i,2]-planeloc[2])*plane[2]) >= 0
+
+if njit is not None :
+    try :
+        vertsonpositiveside = njit(parallel=True, cache=True)(vertsonpositiveside)
+    except RuntimeError :                                   # no cache location, e.g. run from a Text block
+        njit = None                                         # use the NumPy path
+    
+def findvertstostretch(obj, plane, planeloc, coords=None) :
     '''
-    Return all vertices of object obj on the + sign of
+    Return indices of all vertices of object obj on the + sign of
     the plane defined by direction vector plane and 
     point planeloc
+    
+    coords, if given, is the caller's (N,3) float32 copy of the vertex coords.
+    The caller's plane is not modified.
     '''
-    plane.normalize()                                   # unit vector
-    print("Plane: " + str(plane) + " Center: " + str(planeloc))                       # ***TEMP***
-    return [vert for vert in obj.data.vertices if (vert.co-planeloc).dot(plane) >= 0] # vertices in front of plane    
+    plane = np.asarray(plane, dtype=np.float32)
+    plane = plane / np.linalg.norm(plane)               # unit vector
+    if DEBUG :
+        print("Plane: " + str(plane) + " Center: " + str(planeloc))                       # ***TEMP***
+    if coords is None :
+        coords = getcoords(obj.data)
+    planeloc = np.asarray(planeloc, dtype=np.float32)
+    if njit is not None and len(coords) >= NUMBAMINVERTS :  # compiled kernel, worth its compile time
+        keep = np.empty(len(coords), dtype=np.bool_)
+        vertsonpositiveside(coords, planeloc, plane, keep)
+    else :
+        keep = (coords - planeloc) @ plane >= 0
+    return np.flatnonzero(keep)                         # vertices in front of plane
    
 def findlowlodmatch(obj) :
-    print("Selected object: %s" % (obj.name))
-    matches = []
-    for lowlodobj in bpy.data.objects :
-        print("Scene object: %s (%s)" % (lowlodobj.name, lowlodobj.type))    # ***TEMP***
-        if lowlodobj == obj :                       # skip self object
-            continue
-        if not lowlodobj.name.startswith(obj.name) : # skip no name match
-            continue   
-        if not lowlodobj.type == 'MESH':            # only mesh objects
-            continue
-        matches.append(lowlodobj)    
-    return matches
+    if DEBUG :
+        print("Selected object: %s" % (obj.name))
+    prefix = obj.name                               # low LOD names start with the high LOD name
+    return [lowlodobj for lowlodobj in bpy.data.objects
+            if lowlodobj.name.startswith(prefix)    # name match, cheapest test first
+            and lowlodobj != obj                    # skip self object
+            and lowlodobj.type == 'MESH']           # only mesh objects
 
    
         
@@ -201,11 +266,18 @@ class ResizeLODDialogOperator(bpy.types.Operator):
     def run(self, context):
         if not context.selected_objects :
             return({'ERROR_INVALID_INPUT'}, "Nothing selected.")
-        reftarget = context.active_object           # contains the ref points
-        if not reftarget :
-            return({'ERROR_INVALID_INPUT'}, "No active object.")
+        targets = [obj for obj in context.selected_objects if obj.type == 'MESH']  # all selected high LOD meshes
+        if not targets :
+            return({'ERROR_INVALID_INPUT'}, "No mesh selected.")
         try :                                       # do the work
-            adjustboundboxes(reftarget)             # find other object and calc bound boxes
+            matches = dict((target, findlowlodmatch(target)) for target in targets)
+            lowlods = set(lowlodobj for objs in matches.values() for lowlodobj in objs)
+            targets = [target for target in targets if target not in lowlods]   # drop selected low LODs
+            for target in targets :                 # check all before changing any
+                if len(matches[target]) != 1 :
+                    raise ValueError("No unique matching lower LOD mesh for: " + target.name)
+            for target in targets :
+                adjustboundboxes(target, matches[target])  # fit its low LOD to its bound box
             return None
             
         except ValueError as message :
@@ -217,7 +289,22 @@ class ResizeLODDialogOperator(bpy.types.Operator):
         return wm.invoke_props_dialog(self)
 
 
-bpy.utils.register_class(ResizeLODDialogOperator)
+#
+#   register, unregister -- operator registration
+#
+#   Re-running the script with exec() defines a new class. Replace the one
+#   registered by an earlier run rather than registering a second.
+#
+def register() :
+    if hasattr(bpy.types, 'OBJECT_OT_resize_lod_dialog_operator') :  # from a previous run
+        unregister()
+    bpy.utils.register_class(ResizeLODDialogOperator)
+
+def unregister() :
+    bpy.utils.unregister_class(bpy.types.OBJECT_OT_resize_lod_dialog_operator)
+
+
+register()
 
 #   Call this to use.
 def lowlodfit() :